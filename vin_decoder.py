@@ -5,25 +5,109 @@ Reads VIN from images and decodes vehicle information,
 estimates used vehicle value, and stores upload history.
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import os
+import io
+import pybase64
+import threading
+import fcntl
+import queue
+from collections import deque
+from functools import lru_cache
 import anthropic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from datetime import datetime
 import re
-import json
+import orjson
+import time
+from PIL import Image, ImageOps
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and request.get_json)"""
+
+    def dumps(self, obj, **kwargs):
+        # Sorted keys, like Flask's default provider: the frontend renders details in key order
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
-DB_FILE = 'db.json'  # simple storage for upload history
+DB_FILE = 'db.ndjson'  # simple append-only storage for upload history (one JSON record per line)
+HISTORY_LIMIT = 50  # records kept / returned
+HISTORY_MAX_BYTES = 512 * 1024  # DB_FILE is trimmed back to HISTORY_LIMIT records past this size
+HISTORY_LOCK_FILE = DB_FILE + '.lock'  # flock'd by every worker process around appends and trims
+# Base64 of the PNG / JPEG / WEBP magic bytes always starts with these 4 chars
+B64_MAGIC = {'iVBO': 'image/png', '/9j/': 'image/jpeg', 'UklG': 'image/webp'}
+MAX_IMAGE_EDGE = 1024  # longest side (px) of the image sent to Claude Vision
+VIN_PROMPT = "Return only the 17-character VIN from this image. No other text."
+VIN_PATTERN = re.compile(r'^[A-HJ-NPR-Z0-9]{17}$')  # 17 chars, no I/O/Q
+# NHTSA result fields the decoder reads; everything else in the ~140-field payload is dropped
+NHTSA_FIELDS = (
+    'Make', 'Model', 'ModelName', 'Series', 'ModelYear', 'DriveType',
+    'DisplacementL', 'EngineModel', 'PlantCity', 'PlantCountry',
+    'VehicleType', 'BodyClass', 'ErrorCode', 'ErrorText',
+)
+# Check digit (position 9) values and weights, per 49 CFR 565 / SAE J853
+VIN_VALUES = {
+    **{str(d): d for d in range(10)},
+    'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7, 'H': 8,
+    'J': 1, 'K': 2, 'L': 3, 'M': 4, 'N': 5, 'P': 7, 'R': 9,
+    'S': 2, 'T': 3, 'U': 4, 'V': 5, 'W': 6, 'X': 7, 'Y': 8, 'Z': 9,
+}
+VIN_WEIGHTS = (8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2)
+HTTP_TIMEOUT = (3, 8)  # (connect, read) seconds for outbound API calls
+
+
+def read_index_html():
+    """Read the static frontend shell once so / can serve it from memory (None if missing)"""
+    try:
+        with open(os.path.join(app.root_path, 'vin-decoder.html'), 'rb') as html_file:
+            return html_file.read()
+    except OSError:
+        return None
+
+
+INDEX_HTML = read_index_html()
+
+history_queue = queue.Queue()  # records waiting to be appended to DB_FILE
+# Caps in-flight Claude Vision calls per process to stay within API concurrency limits
+claude_slots = threading.BoundedSemaphore(int(os.environ.get('CLAUDE_CONCURRENCY', 8)))
+
+# Shared Anthropic client so the connection to the API stays warm between requests
+claude = anthropic.Anthropic(max_retries=2, timeout=30.0)
+
+# Shared HTTP session so NHTSA / MarketCheck keep-alive connections are reused
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # Bounded retry budget: transient gateway errors only, idempotent GETs only
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=('GET',),
+        respect_retry_after_header=False,  # never sleep for a server-chosen Retry-After delay
+    ),
+))
 
 
 @app.route('/')
 def index():
-    """Serve the frontend HTML file"""
-    return send_from_directory('.', 'vin-decoder.html')
+    """Serve the frontend HTML file (read once at startup)"""
+    if INDEX_HTML is None:
+        abort(404)
+    return Response(INDEX_HTML, mimetype='text/html')
 
 
 @app.route('/api/decode-vin', methods=['POST'])
@@ -34,29 +118,68 @@ def decode_vin():
     2. Use NHTSA API to decode vehicle details
     3. Estimate vehicle used value
     4. Save to history
+
+    JSON body: {"image": "<base64 or data URL>"} or {"vin": "<17-character VIN>"}.
+    A typed "vin" skips Claude Vision and goes straight to the NHTSA decode.
     """
     try:
         data = request.get_json()
-        if not data or 'image' not in data:
+        if not isinstance(data, dict):
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+        if data.get('vin'):
+            if not isinstance(data['vin'], str):
+                return jsonify({'success': False, 'error': 'Invalid VIN provided'}), 400
+            return decode_vin_number(data['vin'].strip().upper())
+        if 'image' not in data:
+            return jsonify({'success': False, 'error': 'No image provided'}), 400
+
+        # Drop any "data:...;base64," header; the payload's own prefix gives the media type
+        image_data = data['image'].partition(',')[2] or data['image']
+        media_type = B64_MAGIC.get(image_data[:4], 'image/jpeg')
+
+        return decode_vin_image(pybase64.b64decode_as_bytearray(image_data), media_type)
+
+    except anthropic.APIError as e:
+        return jsonify({'success': False, 'error': f'Claude API error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Error: {str(e)}'}), 500
+
+
+@app.route('/api/decode-vin-binary', methods=['POST'])
+def decode_vin_binary():
+    """
+    Same as /api/decode-vin, but takes the raw image as a multipart/form-data
+    'image' file instead of a base64 data URL (no base64 on the wire).
+    A 'vin' form field can be sent instead of the image.
+    """
+    try:
+        if request.form.get('vin'):
+            return decode_vin_number(request.form['vin'].strip().upper())
+        upload = request.files.get('image')
+        if not upload:
             return jsonify({'success': False, 'error': 'No image provided'}), 400
 
-        image_data = data['image']
-        if ',' in image_data:
-            header, image_data = image_data.split(',', 1)
-            media_type = 'image/jpeg'
-            if 'png' in header:
-                media_type = 'image/png'
-            elif 'webp' in header:
-                media_type = 'image/webp'
-        else:
-            media_type = 'image/jpeg'
-
-        # --- Step 1: Extract VIN using Claude Vision ---
-        client = anthropic.Anthropic()
-
-        message = client.messages.create(
+        raw = upload.read()
+        return decode_vin_image(raw, sniff_media_type(raw))
+
+    except anthropic.APIError as e:
+        return jsonify({'success': False, 'error': f'Claude API error: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Error: {str(e)}'}), 500
+
+
+def decode_vin_image(raw, media_type):
+    """Run the decode pipeline on raw image bytes and build the JSON response"""
+    raw, media_type = shrink_image(raw, media_type)
+    image_data = pybase64.b64encode(raw).decode('ascii')  # the only base64 encode on this path
+
+    # --- Step 1: Extract VIN using Claude Vision ---
+    with claude_slots:
+        message = claude.messages.create(
             model="claude-sonnet-4-20250514",
-            max_tokens=500,
+            max_tokens=20,  # a VIN is only a handful of tokens
+            temperature=0,
+            stop_sequences=["\n"],
             messages=[
                 {
                     "role": "user",
@@ -67,91 +190,96 @@ def decode_vin():
                         },
                         {
                             "type": "text",
-                            "text": (
-                                "Look at this VIN plate image and extract the 17-character Vehicle Identification "
-                                "Number (VIN). Respond with ONLY the 17-character VIN (no extra text)."
-                            ),
+                            "text": VIN_PROMPT,
                         },
                     ],
                 }
             ],
         )
 
-        vin = message.content[0].text.strip().upper()
-
-        if not re.match(r'^[A-HJ-NPR-Z0-9]{17}$', vin):
-            return jsonify({'success': False, 'error': f'Invalid VIN detected: {vin}'}), 400
-
-        # --- Step 2: Decode VIN using NHTSA Extended API ---
-        nhtsa_url = f'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVinValuesExtended/{vin}?format=json'
-        nhtsa_resp = requests.get(nhtsa_url)
-        vin_data = nhtsa_resp.json().get('Results', [{}])[0]
-
-        make = vin_data.get('Make', 'Unknown')
-        # Try multiple fields for model - NHTSA API can return model in different fields
-        model = (vin_data.get('Model') or 
-                 vin_data.get('ModelName') or 
-                 vin_data.get('Series') or 
-                 'Unknown')
-        year = vin_data.get('ModelYear', 'Unknown')
-        drive_type = vin_data.get('DriveType', 'Unknown')
-        engine = vin_data.get('DisplacementL') or vin_data.get('EngineModel', 'Unknown')
-        manufactured_in = f"{vin_data.get('PlantCity', '')} {vin_data.get('PlantCountry', '')}".strip()
-        vehicle_type = vin_data.get('VehicleType', 'Unknown')
-        body_class = vin_data.get('BodyClass', 'Unknown')
-        
-        # Check for title brand / salvage indicators
-        error_code = vin_data.get('ErrorCode', '')
-        error_text = vin_data.get('ErrorText', '')
-        
-        # Some title information may be available
-        title_status = 'Unknown'
-        if 'salvage' in error_text.lower() or 'rebuilt' in error_text.lower():
-            title_status = '⚠️ Possible Salvage/Rebuilt'
-        elif error_code == '0':
-            title_status = 'No Issues Found in VIN Decode'
-
-        # --- Step 3: Compute vehicle age ---
-        current_year = datetime.now().year
-        age_num = current_year - int(year) if year.isdigit() else None
-        age = f"{age_num} Years" if age_num else "Unknown"
-
-        # --- Step 4: Estimate used price range ---
-        price_low, price_high = estimate_price_range(make, model, year)
-        est_price = f"${price_low:,} - ${price_high:,}" if price_low else "N/A"
-
-        details = {
-            "Make": make,
-            "Model": model,
-            "Year": year,
-            "Drive Type": drive_type,
-            "Engine (L)": engine if engine else "Unknown",
-            "Manufactured In": manufactured_in or "Unknown",
-            "Vehicle Type": vehicle_type,
-            "Body Class": body_class,
-            "Age": age,
-            "Title Status": title_status,
-            "Estimated Used Price": est_price,
-            "Check Accident History": f"https://www.nicb.org/vincheck (VIN: {vin})"
-        }
-
-        # --- Step 5: Save record to history ---
-        save_to_history(vin, details)
-
-        return jsonify({'success': True, 'vin': vin, 'details': details})
+    # The newline stop sequence can yield an empty reply; that falls through to the 400 below
+    vin = ''.join(block.text for block in message.content if block.type == 'text').strip().upper()
+    return decode_vin_number(vin)
 
-    except anthropic.APIError as e:
-        return jsonify({'success': False, 'error': f'Claude API error: {str(e)}'}), 500
-    except Exception as e:
-        return jsonify({'success': False, 'error': f'Error: {str(e)}'}), 500
+
+def decode_vin_number(vin):
+    """Decode an already-read VIN, estimate its value and build the JSON response"""
+    if not VIN_PATTERN.match(vin):
+        return jsonify({'success': False, 'error': f'Invalid VIN detected: {vin}'}), 400
+    if not check_digit_ok(vin):
+        return jsonify({'success': False, 'error': f'Invalid VIN detected: {vin} (check digit mismatch)'}), 400
+
+    # --- Step 2: Decode VIN using NHTSA Extended API ---
+    try:
+        vin_data = nhtsa_decode(vin)
+    except (requests.RequestException, ValueError):
+        vin_data = {}  # NHTSA slow/down or bad body: still return the VIN, with fields marked Unknown
+
+    make = vin_data.get('Make', 'Unknown')
+    # Try multiple fields for model - NHTSA API can return model in different fields
+    model = (vin_data.get('Model') or 
+             vin_data.get('ModelName') or 
+             vin_data.get('Series') or 
+             'Unknown')
+    year = vin_data.get('ModelYear', 'Unknown')
+    drive_type = vin_data.get('DriveType', 'Unknown')
+    engine = vin_data.get('DisplacementL') or vin_data.get('EngineModel', 'Unknown')
+    manufactured_in = f"{vin_data.get('PlantCity', '')} {vin_data.get('PlantCountry', '')}".strip()
+    vehicle_type = vin_data.get('VehicleType', 'Unknown')
+    body_class = vin_data.get('BodyClass', 'Unknown')
+    
+    # Check for title brand / salvage indicators
+    error_code = vin_data.get('ErrorCode', '')
+    error_text = vin_data.get('ErrorText', '')
+    
+    # Some title information may be available
+    title_status = 'Unknown'
+    if 'salvage' in error_text.lower() or 'rebuilt' in error_text.lower():
+        title_status = '⚠️ Possible Salvage/Rebuilt'
+    elif error_code == '0':
+        title_status = 'No Issues Found in VIN Decode'
+
+    # --- Step 3: Compute vehicle age ---
+    age_num = current_year() - int(year) if year.isdigit() else None
+    age = f"{age_num} Years" if age_num else "Unknown"
+
+    # --- Step 4: Estimate used price range ---
+    price_low, price_high = estimate_price_range(make, model, year)
+    est_price = f"${price_low:,} - ${price_high:,}" if price_low else "N/A"
+
+    details = {
+        "Make": make,
+        "Model": model,
+        "Year": year,
+        "Drive Type": drive_type,
+        "Engine (L)": engine if engine else "Unknown",
+        "Manufactured In": manufactured_in or "Unknown",
+        "Vehicle Type": vehicle_type,
+        "Body Class": body_class,
+        "Age": age,
+        "Title Status": title_status,
+        "Estimated Used Price": est_price,
+        "Check Accident History": f"https://www.nicb.org/vincheck (VIN: {vin})"
+    }
+
+    # --- Step 5: Save record to history (written by a background thread) ---
+    save_to_history(vin, details)
+
+    return jsonify({'success': True, 'vin': vin, 'details': details})
 
 
 @app.route('/api/history')
 def history():
-    """Return all saved VIN decode history"""
+    """Return the most recent VIN decode history, newest first"""
     if os.path.exists(DB_FILE):
-        with open(DB_FILE) as f:
-            records = json.load(f)
+        with open(DB_FILE, 'rb') as f:
+            lines = deque(f, maxlen=HISTORY_LIMIT)
+        records = []
+        for line in reversed(lines):
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue  # skip a torn / partially written line
         return jsonify(records)
     return jsonify([])
 
@@ -164,6 +292,68 @@ def health():
 
 # --- Utility functions ---------------------------------------------------
 
+_year_cache = {'year': datetime.now().year, 'checked': time.time()}
+
+
+def current_year():
+    """Current calendar year, re-read from the clock at most once a day"""
+    if time.time() - _year_cache['checked'] > 86400:
+        _year_cache['year'] = datetime.now().year
+        _year_cache['checked'] = time.time()
+    return _year_cache['year']
+
+
+def check_digit_ok(vin):
+    """
+    Verify the mod-11 check digit of a VIN already matching VIN_PATTERN.
+    Only North American VINs (WMI starting 1-5) are required to carry one,
+    so other regions always pass.
+    """
+    if vin[0] not in '12345':
+        return True
+    total = sum(VIN_VALUES[c] * w for c, w in zip(vin, VIN_WEIGHTS)) % 11
+    return vin[8] == ('X' if total == 10 else str(total))
+
+
+def sniff_media_type(raw):
+    """Guess the image media type from its magic bytes (defaults to JPEG)"""
+    if raw[:4] == b'\x89PNG':
+        return 'image/png'
+    if raw[:4] == b'RIFF' and raw[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def shrink_image(raw, media_type):
+    """
+    Downscale raw image bytes to MAX_IMAGE_EDGE and re-encode them as JPEG.
+    Full-resolution phone photos cost far more vision tokens than needed to read a VIN.
+    Falls back to the original data if the image can't be decoded.
+    """
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', quality=80, optimize=True)
+        return buf.getvalue(), 'image/jpeg'
+    except Exception:
+        return raw, media_type
+
+
+@lru_cache(maxsize=4096)
+def nhtsa_decode(vin):
+    """
+    Decode a VIN with the NHTSA Extended API (cached, a VIN always decodes the same).
+    Only NHTSA_FIELDS are kept so cached entries stay small.
+    """
+    nhtsa_url = f'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVinValuesExtended/{vin}?format=json'
+    nhtsa_resp = session.get(nhtsa_url, timeout=HTTP_TIMEOUT)
+    nhtsa_resp.raise_for_status()  # errors raise, so they never land in the cache
+    result = orjson.loads(nhtsa_resp.content).get('Results', [{}])[0]
+    return {key: result[key] for key in NHTSA_FIELDS if key in result}
+
+
 def estimate_price_range(make, model, year):
     """
     Option A: Use MarketCheck API if available via environment variable.
@@ -172,44 +362,92 @@ def estimate_price_range(make, model, year):
     key = os.environ.get('MARKETCHECK_KEY')
     try:
         if key:
-            url = (
-                f"https://api.marketcheck.com/v2/depreciation?"
-                f"api_key={key}&year={year}&make={make}&model={model}"
-            )
-            resp = requests.get(url)
-            if resp.ok:
-                data = resp.json()
-                price_range = data.get('price_range')
-                if price_range:
-                    return int(price_range['min']), int(price_range['max'])
+            price_range = marketcheck_price_range(key, make, model, year)
+            if price_range:
+                return price_range
     except Exception:
         pass
 
     # --- fallback simple formula ---
     if not year.isdigit():
         return None, None
-    age = datetime.now().year - int(year)
+    age = current_year() - int(year)
     base_price = 35000  # you can adjust or vary by class
     value = base_price * (0.85 ** age)
     return round(value * 0.8), round(value * 1.2)
 
 
+@lru_cache(maxsize=8192)
+def marketcheck_price_range(key, make, model, year):
+    """
+    Fetch a (min, max) price range from MarketCheck, or None if it has no data.
+    Cached per (make, model, year); failed requests raise, so they are never cached.
+    """
+    url = (
+        f"https://api.marketcheck.com/v2/depreciation?"
+        f"api_key={key}&year={year}&make={make}&model={model}"
+    )
+    resp = session.get(url, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    price_range = orjson.loads(resp.content).get('price_range')
+    if not price_range:
+        return None
+    return int(price_range['min']), int(price_range['max'])
+
+
 def save_to_history(vin, details):
-    """Save each decoded VIN result locally"""
+    """Queue each decoded VIN result to be saved locally"""
     record = {
         'vin': vin,
         'timestamp': datetime.now().isoformat(),
         'details': details
     }
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, 'r+') as f:
-            data = json.load(f)
-            data.insert(0, record)
-            f.seek(0)
-            json.dump(data[:50], f, indent=2)  # keep last 50 records
-    else:
-        with open(DB_FILE, 'w') as f:
-            json.dump([record], f, indent=2)
+    history_queue.put(record)
+
+
+def trim_history():
+    """Rewrite DB_FILE with only its last HISTORY_LIMIT lines (caller holds the history lock)"""
+    if not os.path.exists(DB_FILE):
+        return
+    with open(DB_FILE, 'rb') as f:
+        lines = deque(f, maxlen=HISTORY_LIMIT)
+    tmp_file = f"{DB_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.writelines(lines)
+    os.replace(tmp_file, DB_FILE)
+
+
+def history_writer():
+    """
+    Append queued history records to DB_FILE, trimming it on startup and
+    whenever it grows past HISTORY_MAX_BYTES. Every worker process runs one
+    of these, so appends and trims are serialized with a lock file.
+    """
+    with open(HISTORY_LOCK_FILE, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            trim_history()
+        except Exception as e:
+            print(f"⚠️ Failed to trim history: {e}")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        while True:
+            record = history_queue.get()
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                with open(DB_FILE, 'ab') as f:
+                    f.write(orjson.dumps(record) + b'\n')
+                    size = f.tell()
+                if size > HISTORY_MAX_BYTES:
+                    trim_history()
+            except Exception as e:
+                print(f"⚠️ Failed to save history: {e}")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+threading.Thread(target=history_writer, daemon=True).start()
 
 
 # --- App Runner -----------------------------------------------------------